@@ -1,3 +1,5 @@
 '''initialize fluxvault'''
 from fluxvault.vault import FluxNode
 from fluxvault.vault import FluxAgent
+from fluxvault.vault import use_fast_event_loop
+from fluxvault.vault import close_connection
@@ -1,19 +1,99 @@
 '''This module is a single file that supports the loading of secrets into a Flux Node'''
-import binascii
-import json
+import asyncio
+import logging
+import os
+import struct
 import sys
 import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime
 import socket
-from Crypto.PublicKey import RSA
-from Crypto.Random import get_random_bytes
-from Crypto.Cipher import AES, PKCS1_OAEP
+import msgpack
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+log = logging.getLogger("fluxvault")
 
 VAULT_NAME = ""
 BOOTFILES = []
 FILE_DIR = ""
 
 MAX_MESSAGE = 8192
+# Largest encrypted frame we will accept from a peer
+MAX_FRAME = 16 * 1024 * 1024
+
+# Seconds allowed for the Agent to connect to a Node, and to wait for each reply
+CONNECT_TIMEOUT = 30
+RECEIVE_TIMEOUT = 60
+
+# Seconds a rejected peer IP is dropped without logging, and how many are remembered
+REJECT_TTL = 15
+MAX_REJECTED = 1024
+
+# Session key length (AES-256 or ChaCha20) and the HKDF context it is derived with
+SESSION_KEY_SIZE = 32
+SESSION_KEY_INFO = b"FluxVault session key"
+
+# AEAD nonce length in bytes (96 bits for both AES-GCM and ChaCha20-Poly1305)
+NONCE_SIZE = 12
+
+# Every message on the wire is prefixed with the length of its payload
+LENGTH_HEADER = struct.Struct("!I")
+
+# An encrypted frame payload starts with the length of the message section, the body
+# section (if any) is the rest. Each section is the nonce followed by the AEAD ciphertext
+SECTION_HEADER = struct.Struct("!I")
+
+# Files are CRC'd this many bytes at a time so memory use does not grow with file size
+CRC_CHUNK = 1024 * 1024
+
+# Files changed less than this many nanoseconds ago are never served from a CRC cache,
+# a rewrite within one timestamp tick (up to 2s on FAT) would keep the same stat fields
+CRC_CACHE_MIN_AGE = 2 * 1000 * 1000 * 1000
+
+def use_fast_event_loop() -> bool:
+    '''
+    Make asyncio.run use uvloop (winloop on Windows) if it is installed, they are optional
+    Returns False and leaves the default event loop if neither is available
+    '''
+    try:
+        if sys.platform == "win32":
+            import winloop as fast_loop # pylint: disable=import-outside-toplevel
+        else:
+            import uvloop as fast_loop # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(fast_loop.EventLoopPolicy())
+    return True
+
+def has_aes_instructions() -> bool:
+    '''
+    Probe once for hardware AES (x86 AES-NI "aes" flag, ARMv8 "aes" feature)
+    FLUXVAULT_AESNI=1 or 0 skips the probe
+    '''
+    override = os.getenv("FLUXVAULT_AESNI")
+    if override is not None:
+        return override == "1"
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith(("flags", "Features")):
+                    return "aes" in line.split()
+    except OSError:
+        pass
+    # No cpuinfo (not Linux), assume a CPU with AES instructions
+    return True
+
+# Session ciphers by the name the Node announces, both take a 32 byte key and 12 byte nonce
+SESSION_CIPHERS = {"AESGCM": AESGCM, "CHACHA20": ChaCha20Poly1305}
+# Picked once at import: AES-GCM with hardware AES, else ChaCha20-Poly1305 which is
+# faster in software. The Node sends its choice, the Agent follows it
+SESSION_CIPHER = "AESGCM" if has_aes_instructions() else "CHACHA20"
 
 DISCONNECTED = "DISCONNECTED"
 CONNECTED = "CONNECTED"
@@ -33,183 +113,313 @@ DATA = "DATA"
 
 # Utility routines used by Node, Vault or Both
 
-def encrypt_data(keypem, data):
-    '''Used by the Vault to create and send a AES session key protected by RSA'''
-    key = RSA.import_key(keypem)
-    session_key = get_random_bytes(16)
-    # Encrypt the session key with the public RSA key
-    cipher_rsa = PKCS1_OAEP.new(key)
-    enc_session_key = cipher_rsa.encrypt(session_key)
-
-    # Encrypt the data with the AES session key
-    cipher_aes = AES.new(session_key, AES.MODE_EAX)
-    ciphertext, tag = cipher_aes.encrypt_and_digest(data)
-
-    msg = {
-        "enc_session_key":enc_session_key.hex(),
-        "nonce": cipher_aes.nonce.hex(),
-        "tag": tag.hex(),
-        "cipher": ciphertext.hex()
-    }
-    return msg
-
-def decrypt_data(keypem, cipher):
-    '''Used by Node to decrypt and return the AES Session key using the RSA Key'''
-    private_key = RSA.import_key(keypem)
-    enc_session_key = bytes.fromhex(cipher["enc_session_key"])
-    nonce = bytes.fromhex(cipher["nonce"])
-    tag = bytes.fromhex(cipher["tag"])
-    ciphertext = bytes.fromhex(cipher["cipher"])
+def public_key_bytes(private_key):
+    '''Raw 32 byte X25519 public key to send to our peer'''
+    return private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
 
-    # Decrypt the session key with the private RSA key
-    cipher_rsa = PKCS1_OAEP.new(private_key)
-    session_key = cipher_rsa.decrypt(enc_session_key)
+def derive_session_key(private_key, peer_public_key):
+    '''
+    Used by both Node and Vault to agree on the session key
+    X25519 ECDH with our ephemeral private key and the peer public key, then HKDF-SHA256
+    Raises ValueError if the peer key is not a valid X25519 public key
+    '''
+    if not isinstance(peer_public_key, X25519PublicKey):
+        peer_public_key = X25519PublicKey.from_public_bytes(peer_public_key)
+    shared_key = private_key.exchange(peer_public_key)
+    return HKDF(algorithm=hashes.SHA256(), length=SESSION_KEY_SIZE,
+                salt=None, info=SESSION_KEY_INFO).derive(shared_key)
 
-    # Decrypt the data with the AES session key
-    cipher_aes = AES.new(session_key, AES.MODE_EAX, nonce)
-    data = cipher_aes.decrypt_and_verify(ciphertext, tag)
-    return data
+def write_file(path, data):
+    '''
+    Replace a file with data, readers never see half a file
+    A new file gets the umask default mode. When replacing, the temp file is created
+    owner only, then given the mode (and owner where permitted) of the file it replaces
+    so a secret never widens its permissions
+    '''
+    tmp = path + ".tmp"
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        stat = None
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    mode = 0o666 if stat is None else 0o600
+    try:
+        fd = os.open(tmp, flags, mode)
+    except FileExistsError:
+        # Left over from an interrupted write, O_EXCL still refuses a racing writer
+        os.unlink(tmp)
+        fd = os.open(tmp, flags, mode)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+            file.flush()
+            # On disk before the rename, a crash must not leave a renamed empty file
+            os.fsync(file.fileno())
+        if stat is not None:
+            os.chmod(tmp, stat.st_mode & 0o7777)
+            if hasattr(os, "chown"):
+                try:
+                    os.chown(tmp, stat.st_uid, stat.st_gid)
+                except PermissionError:
+                    pass
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
 
-def decrypt_aes_data(key, data):
+def file_crc(path, cache=None):
     '''
-    Accept out cipher text object
-    Decrypt data with AES key
+    CRC32 of a file's raw bytes, read in CRC_CHUNK pieces into one reused buffer
+    With a cache dict the file is only read again if its size, inode or times changed
+    since the last call, files changed within CRC_CACHE_MIN_AGE are always read
+    Raises FileNotFoundError if the file does not exist
+    '''
+    crc = 0
+    with open(path, "rb", buffering=0) as file:
+        stat = os.fstat(file.fileno())
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns)
+        age = time.time_ns() - max(stat.st_mtime_ns, stat.st_ctime_ns)
+        if cache is None or age < CRC_CACHE_MIN_AGE:
+            cache = {}
+        cached = cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        # Small files get a buffer of their own size, not a full CRC_CHUNK
+        view = memoryview(bytearray(min(stat.st_size, CRC_CHUNK)))
+        while count := file.readinto(view):
+            crc = zlib.crc32(view[:count], crc)
+    cache[path] = (signature, crc)
+    return crc
+
+def decrypt_aes_data(aead, data):
+    '''
+    Accept our binary frame payload
+    Decrypt message (and body if present) with the session AEAD cipher
+    The sections are sliced from a memoryview, no copies before decryption
     '''
     try:
-        jdata = json.loads(data)
-        nonce = bytes.fromhex(jdata["nonce"])
-        tag = bytes.fromhex(jdata["tag"])
-        ciphertext = bytes.fromhex(jdata["ciphertext"])
-
-        # let's assume that the key is somehow available again
-        cipher = AES.new(key, AES.MODE_EAX, nonce)
-        msg = cipher.decrypt_and_verify(ciphertext, tag)
-    except ValueError:
+        frame = memoryview(data)
+        (msg_len,) = SECTION_HEADER.unpack_from(frame)
+        offset = SECTION_HEADER.size + msg_len
+        section = frame[SECTION_HEADER.size:offset]
+        # The AEAD tag is the tail of the ciphertext and is verified here
+        msg = msgpack.unpackb(aead.decrypt(section[:NONCE_SIZE], section[NONCE_SIZE:], None),
+                              raw=False)
+        if not isinstance(msg, dict):
+            return { "State": FAILED}
+        if len(frame) > offset:
+            # Bulk file payload was encrypted on its own, outside the msgpack message
+            # with the message section as associated data, so it only opens with the
+            # message it was sent with. It is returned as bytes, never decoded
+            body = frame[offset:]
+            msg["Body"] = aead.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], section)
+    except (ValueError, InvalidTag, struct.error):
         return { "State": FAILED}
-    return json.loads(msg)
+    return msg
 
-def encrypt_aes_data(key, message):
+def encrypt_aes_data(aead, message):
     '''
-    Take a json object, dump it in plain text
-    Encrypt message with AES key
-    Create a json object with the cipher text and digest
-    Then return that object in plain text to send to our peer
+    Take a message dict, pack it with msgpack
+    Encrypt message with the session AEAD cipher (created once per connection)
+    Return a length prefixed binary frame of nonce and cipher text (AEAD tag appended)
+    to send to our peer
+
+    A file "Body" (bytes) is not packed with the message, it is encrypted as is in a single
+    AEAD call (with AES-GCM, OpenSSL pipelines the CTR blocks) with its own nonce and the
+    message section as associated data, binding the body to this message
     '''
-    msg = json.dumps(message)
-    cipher = AES.new(key, AES.MODE_EAX)
-    ciphertext, tag = cipher.encrypt_and_digest(msg.encode("utf-8"))
-    jdata = {
-        "nonce": cipher.nonce.hex(),
-        "tag": tag.hex(),
-        "ciphertext": ciphertext.hex()
-    }
-    data = json.dumps(jdata)
-    return data
-
-def send_receive(sock, request):
+    body = message.get("Body", b"")
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if len(body) > 0:
+        message = {name: value for name, value in message.items() if name != "Body"}
+    msg = msgpack.packb(message, use_bin_type=True)
+    nonce = os.urandom(NONCE_SIZE)
+    ciphertext = aead.encrypt(nonce, msg, None)
+    msg_len = NONCE_SIZE + len(ciphertext)
+    if len(body) == 0:
+        return b"".join((LENGTH_HEADER.pack(SECTION_HEADER.size + msg_len),
+                         SECTION_HEADER.pack(msg_len), nonce, ciphertext))
+    body_nonce = os.urandom(NONCE_SIZE)
+    body_ciphertext = aead.encrypt(body_nonce, body, nonce + ciphertext)
+    frame_len = SECTION_HEADER.size + msg_len + NONCE_SIZE + len(body_ciphertext)
+    # Join once, the file contents are copied a single time into the frame
+    return b"".join((LENGTH_HEADER.pack(frame_len), SECTION_HEADER.pack(msg_len),
+                     nonce, ciphertext, body_nonce, body_ciphertext))
+
+def pack_message(message):
+    '''Pack a plain (unencrypted) message with msgpack and prefix it with its length'''
+    payload = msgpack.packb(message, use_bin_type=True)
+    return LENGTH_HEADER.pack(len(payload)) + payload
+
+async def receive_payload(reader, limit):
     '''
-    Send a request message and wait for a reply
+    Read one length prefixed payload from an asyncio.StreamReader
+    The payload bytes are returned as read, without joining the header back on
+    Returns b"" if the peer closed the connection or the payload is larger than limit
     '''
-    request += "\n"
-
     try:
-        sock.sendall(request.encode("utf-8"))
-    except socket.error:
-        print('Send failed')
-        sys.exit()
+        (size,) = LENGTH_HEADER.unpack(await reader.readexactly(LENGTH_HEADER.size))
+        if size > limit:
+            return b""
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        return b""
+
+async def receive_message(reader):
+    '''Read one plain message payload, b"" on close or if too large'''
+    return await receive_payload(reader, MAX_MESSAGE)
+
+async def receive_frame(reader):
+    '''Read one encrypted frame payload, b"" on close or if too large'''
+    return await receive_payload(reader, MAX_FRAME)
+
+async def send_receive(reader, writer, request):
+    '''
+    Send a request message (bytes) and wait for an encrypted frame as the reply
+    '''
+    try:
+        writer.write(request)
+        await writer.drain()
+    except ConnectionError:
+        log.warning("Send failed")
+        return None
 
     # Receive data
     try:
-        reply = sock.recv(MAX_MESSAGE)
-    except TimeoutError:
-        print('Receive time out')
+        reply = await asyncio.wait_for(receive_frame(reader), RECEIVE_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Receive time out")
         return None
-    reply = reply.decode("utf-8")
     return reply
 
-# pylint: disable=W0702
-def receive_only(sock):
+async def receive_only(reader):
     '''
-    Wait for a message from our peer
+    Wait for a plain message from our peer
     '''
     # Receive data
     try:
-        reply = sock.recv(MAX_MESSAGE)
-        reply = reply.decode("utf-8")
-    except:
-        reply = ""
+        reply = await asyncio.wait_for(receive_message(reader), RECEIVE_TIMEOUT)
+    except (asyncio.TimeoutError, ConnectionError):
+        reply = b""
     return reply
 
-def receive_public_key(sock):
-    '''Receive Public Key from the Node or return None on error'''
-    try:
-        reply = receive_only(sock)
-    except TimeoutError:
-        return None
-
+async def receive_public_key(reader):
+    '''
+    Receive Public Key from the Node
+    Returns the X25519 public key and the session cipher class the Node chose, or None on error
+    '''
+    reply = await receive_only(reader)
     if len(reply) == 0:
         return None
     try:
-        jdata = json.loads(reply)
-        public_key = jdata["PublicKey"].encode("utf-8")
-    except ValueError:
+        jdata = msgpack.unpackb(reply, raw=False)
+        if not isinstance(jdata, dict):
+            return None
+        public_key = X25519PublicKey.from_public_bytes(jdata["PublicKey"])
+        session_cipher = SESSION_CIPHERS[jdata["Cipher"]]
+    except (ValueError, KeyError, TypeError):
+        # Unauthenticated message, anything malformed just ends the session
         return None
-    return public_key
+    return public_key, session_cipher
+
+async def close_connection(writer):
+    '''Close our side of a connection, the peer may already have gone'''
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
 
 class FluxNode:
     '''Create a small server that runs on the Node waiting for Vault to connect'''
     vault_name = ""
+    vault_ip = ""
+    rejected = OrderedDict()
     user_files = []
     file_dir = ""
     def __init__(self) -> None:
         self.nkdata = { "State": DISCONNECTED }
         self.user_request_count = 1
-        self.reply = "reply"
+        self.reply = b""
         self.request = ""
         self.agent_response = {}
         self.agent_response[PASSED] = self.agent_passed
         self.agent_response[DATA] = self.agent_data
+        self.state_message = {}
+        self.state_message[KEYSENT] = self.keysent_message
+        self.state_message[STARTAES] = self.startaes_message
+        self.state_message[READY] = self.ready_message
 
-    def connected(self, peer_ip: str) -> bool:
-        '''Call when connection is established to verify correct source IP'''
-         # Verify the connection came from our Vault IP Address
-        if len(self.vault_name) == 0:
-            print("Vault Name not configured in FluxNode class or child class")
+    @classmethod
+    def resolve_vault_name(cls) -> bool:
+        '''
+        Look up the vault_name IP address and cache it in vault_ip for every connection
+        Call at server start and periodically if the name can move (dyn-dns)
+        '''
+        if len(cls.vault_name) == 0:
+            log.error("Vault Name not configured in FluxNode class or child class")
             return False
-        hname = self.vault_name
         try:
-            result = socket.gethostbyname(hname)
+            cls.vault_ip = socket.gethostbyname(cls.vault_name)
         except socket.gaierror:
-            print("Vault name not vaild DNS ", hname)
+            log.error("Vault name not vaild DNS %s", cls.vault_name)
             return False
+        return True
+
+    def connected(self, peer_ip: str) -> bool:
+        '''Call when connection is established to verify correct source IP'''
+        # Verify the connection came from our Vault IP Address, no DNS lookup per connection
+        # until resolve_vault_name has succeeded vault_ip is empty and nothing matches
+        result = self.vault_ip
         if peer_ip[0] != result:
-            # Delay invalid peer to defend against DOS attack
-            time.sleep(15)
-            print( "Reject Connection, wrong IP:" + peer_ip[0] + " Expected " + result)
+            # Close right away, repeat offenders are dropped quietly for REJECT_TTL seconds
+            now = time.monotonic()
+            last_seen = self.rejected.get(peer_ip[0])
+            self.rejected[peer_ip[0]] = now
+            self.rejected.move_to_end(peer_ip[0])
+            if len(self.rejected) > MAX_REJECTED:
+                self.rejected.popitem(last=False)
+            if last_seen is None or now - last_seen > REJECT_TTL:
+                log.warning("Reject Connection, wrong IP: %s Expected %s", peer_ip[0], result)
             return False
         self.nkdata = { "State": CONNECTED }
         self.user_request_count = 1
         return True
 
-    def handle(self, read, write):
-        '''Gets called from socket thread to handle incoming data'''
+    async def handle(self, reader, writer):
+        '''
+        Gets called from the asyncio server to handle incoming data
+        reader/writer are the asyncio streams of the connection to the Agent
+        '''
         reply = self.create_send_public_key()
 
-        while True:
-            if len(reply) > 0:
-                write(reply.encode("utf-8"))
-
-            data = read()
-            if not data:
-                # No Message - Get Out
-                break
-            state = self.process_message(data)
-            if state == READY:
-                state = self.agent_action() # process agent commands
-            if state == FAILED:
-                # Something went wrong, abort
-                break
-            reply = self.reply
+        try:
+            while True:
+                if len(reply) > 0:
+                    writer.write(reply)
+                    await writer.drain()
+
+                if self.current_state() == KEYSENT:
+                    # The Agent Public Key is the only plain message we receive
+                    data = await receive_message(reader)
+                else:
+                    data = await receive_frame(reader)
+                if not data:
+                    # No Message - Get Out
+                    return
+                state = self.process_message(data)
+                if state == READY:
+                    state = self.agent_action() # process agent commands
+                if state == FAILED:
+                    # Something went wrong, abort
+                    return
+                reply = self.reply
+        except ConnectionError:
+            log.info("connection lost")
         # When we return the connection is closed
 
     def current_state(self) -> str:
@@ -219,62 +429,78 @@ class FluxNode:
     def create_send_public_key(self):
         '''
         New incoming connection from Vault
-        Create a new RSA key and send the Public Key the Vault
+        Create a new X25519 key and send the Public Key the Vault
         The message should be signed by the Flux Node we are running on
         so we can authenticate the message
 
         This is the only message sent unencrypted.
         This is Ok because the Public Key can be Public
         '''
-        self.nkdata["RSAkey"] = RSA.generate(2048)
-        self.nkdata["Private"] = self.nkdata["RSAkey"].export_key()
-        self.nkdata["Public"] = self.nkdata["RSAkey"].publickey().export_key()
+        # An ephemeral X25519 key takes microseconds, no prime search as with RSA
+        self.nkdata["PrivateKey"] = X25519PrivateKey.generate()
+        self.nkdata["Public"] = public_key_bytes(self.nkdata["PrivateKey"])
         self.nkdata["State"] = KEYSENT
-        jdata = { "State": KEYSENT, "PublicKey": self.nkdata["Public"].decode("utf-8")}
-        reply = json.dumps(jdata) + "\n"
+        jdata = { "State": KEYSENT, "PublicKey": self.nkdata["Public"], "Cipher": SESSION_CIPHER}
+        reply = pack_message(jdata)
         # Add this signed_reply = flux_node_sign_message(reply)
         return reply
 
     def process_message(self, data) -> str:
-        '''Process incoming message to get to the Ready state and then capture incoming request'''
+        '''
+        Process incoming message to get to the Ready state and then capture incoming request
+        The current state selects the handler in the self.state_message dict
+        '''
+        self.reply = b""
+        handler = self.state_message.get(self.nkdata["State"])
+        if handler is None:
+            self.nkdata["State"] = FAILED
+            return FAILED
         try:
-            self.reply = ""
-            # We send our Public key and expect an AES Key for our session, if not Get Out
-            if self.nkdata["State"] == KEYSENT:
-                jdata = json.loads(data)
-                if jdata["State"] != AESKEY:
-                    self.nkdata["State"] = FAILED # Tollerate no errors
-                else:
-                    # Decrypt with our RSA Private Key
-                    self.nkdata["AESKEY"] = decrypt_data(self.nkdata["Private"], jdata)
-                    self.nkdata["State"] = STARTAES
-                    # Send a test encryption message, always include random data
-                    random = get_random_bytes(16).hex()
-                    jdata = { "State": STARTAES, "Text": "Test", "fill": random}
-                    # Encrypt with AES Key and send reply
-                    self.reply = encrypt_aes_data(self.nkdata["AESKEY"], jdata) + "\n"
-            else:
-                if self.nkdata["State"] == STARTAES:
-                    # Do we both have the same AES Key?
-                    jdata = decrypt_aes_data(self.nkdata["AESKEY"], data)
-                    if jdata["State"] == STARTAES and jdata["Text"] == "Passed":
-                        self.nkdata["State"] = PASSED # We are good to go!
-                    else:
-                        self.nkdata["State"] = FAILED # Tollerate no errors
-            if self.nkdata["State"] == READY:
-                # Decrypt message from Vault so user code can handle it
-                # This will be a reply to a request the Node made
-                # The user code will then issue a new request or call done
-                self.request = decrypt_aes_data(self.nkdata["AESKEY"], data)
-            if self.nkdata["State"] == PASSED:
-                self.nkdata["State"] = READY
-                self.request = {"State": PASSED} # Initial state, no reply, send first request
-        except ValueError:
-            # Decryption error or unhandled exception with close connection
+            handler(data)
+        except (ValueError, KeyError, TypeError):
+            # Malformed message or key agreement error will close connection
             self.nkdata["State"] = FAILED
-            print("process message failed")
+            log.warning("process message failed")
         return self.current_state()
 
+    def keysent_message(self, data) -> None:
+        '''We sent our Public key and expect the Agent Public key, if not Get Out'''
+        jdata = msgpack.unpackb(data, raw=False)
+        if jdata["State"] != AESKEY:
+            self.nkdata["State"] = FAILED # Tollerate no errors
+            return
+        # Derive the session key from our Private Key and the Agent Public Key
+        # the session cipher (key schedule) is set up once for the whole session
+        session_cipher = SESSION_CIPHERS[SESSION_CIPHER]
+        self.nkdata["AEAD"] = session_cipher(derive_session_key(self.nkdata["PrivateKey"],
+                                                                jdata["PublicKey"]))
+        self.nkdata["State"] = STARTAES
+        # Send a test encryption message, the random AEAD nonce makes
+        # every cipher text unique so no random fill is needed
+        jdata = { "State": STARTAES, "Text": "Test"}
+        # Encrypt with the session key and send reply
+        self.reply = encrypt_aes_data(self.nkdata["AEAD"], jdata)
+
+    def startaes_message(self, data) -> None:
+        '''Do we both have the same session key?'''
+        jdata = decrypt_aes_data(self.nkdata["AEAD"], data)
+        if jdata["State"] != STARTAES or jdata["Text"] != "Passed":
+            self.nkdata["State"] = FAILED # Tollerate no errors
+            return
+        # We are good to go!
+        self.nkdata["State"] = READY
+        self.request = {"State": PASSED} # Initial state, no reply, send first request
+
+    def ready_message(self, data) -> None:
+        '''
+        Decrypt message from Vault so user code can handle it
+        This will be a reply to a request the Node made
+        The user code will then issue a new request or call done
+        '''
+        self.request = decrypt_aes_data(self.nkdata["AEAD"], data)
+        if self.request.get("State") == FAILED:
+            self.nkdata["State"] = FAILED
+
     def agent_action(self):
         '''
         Handle Agent replies, the response "State" field tells us what action is needed.
@@ -286,37 +512,44 @@ class FluxNode:
         The default user_request function will request all files define in the bootfiles array
         The MyFluxNode class (example in vault_node.py) can redefine teh user_request function
         '''
-        if self.agent_response[self.request["State"]]():
+        state = self.request.get("State")
+        agent_func = self.agent_response.get(state) if isinstance(state, str) else None
+        if agent_func is not None and agent_func():
             # The Received message was processed, generate the next request
             if self.user_request(self.user_request_count):
                 self.user_request_count = self.user_request_count + 1
-                random = get_random_bytes(16).hex()
-                self.request["fill"] = random
-                self.reply = encrypt_aes_data(self.nkdata["AESKEY"], self.request)
+                self.reply = encrypt_aes_data(self.nkdata["AEAD"], self.request)
                 return PASSED
         return FAILED
 
     def agent_passed(self) -> bool:
         '''Node side processing of vault replies for all predefined actions'''
-        if self.request["State"] == PASSED:
-            return True
-        return False
+        return self.request.get("State") == PASSED
 
     def agent_data(self) -> bool:
-        '''Node side processing of vault replies for all predefined actions'''
-        if self.request["State"] == DATA:
-            if self.request["Status"] == "Success":
-                with open(self.file_dir+self.request["FILE"], "w", encoding="utf-8") as file:
-                    file.write(self.request["Body"])
-                    file.close()
-                    print(self.request["FILE"], " received!")
-                    return True
-            if self.request["Status"] == "Match":
-                print(self.request["FILE"], " Match!")
-                return True
-            if self.request["Status"] == "FileNotFound":
-                print(self.request["FILE"], " was not found?")
-                return True
+        '''
+        Node side processing of vault replies for all predefined actions
+        A reply missing fields returns False, agent_action then fails the session
+        '''
+        fname = self.request.get("FILE")
+        if self.request.get("State") != DATA or not isinstance(fname, str):
+            return False
+        status = self.request.get("Status")
+        if status == "Success":
+            body = self.request.get("Body", b"")
+            if not isinstance(body, bytes):
+                return False
+            # Body is the decrypted bytes, written as is (binary mode, no newline
+            # translation) keeping the permissions of the file it replaces
+            write_file(self.file_path(fname), body)
+            log.info("%s received!", fname)
+            return True
+        if status == "Match":
+            log.info("%s Match!", fname)
+            return True
+        if status == "FileNotFound":
+            log.info("%s was not found?", fname)
+            return True
         return False
 
     def request_done(self) -> None:
@@ -324,14 +557,14 @@ class FluxNode:
         self.request = { "State": DONE }
         return True
 
+    def file_path(self, fname) -> str:
+        '''Local path of a user file, file_dir does not need a trailing separator'''
+        return os.path.join(self.file_dir, fname)
+
     def request_file(self, fname) -> None:
         '''Open the file and compute the crc, set crc=0 if not found'''
         try:
-            with open(self.file_dir+fname, encoding="utf-8") as file:
-                content = file.read()
-                file.close()
-            crc = binascii.crc32(content.encode("utf-8"))
-            # File exists
+            crc = file_crc(self.file_path(fname))
         except FileNotFoundError:
             crc = 0
         self.request = { "State": REQUEST, "FILE": fname, "crc32": crc }
@@ -346,46 +579,19 @@ class FluxNode:
         return False
 
 # Routines for fluxVault class
-def open_connection(port, appip):
-    '''Open socket to Node'''
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    except socket.error:
-        return 'Failed to create socket'
-
+async def open_connection(port, appip):
+    '''Open connection to Node, returns the asyncio (reader, writer) pair or an error string'''
     try:
-        remote_ip = socket.gethostbyname( appip )
+        connection = await asyncio.wait_for(asyncio.open_connection(appip, port), CONNECT_TIMEOUT)
     except socket.gaierror:
         return 'Hostname could not be resolved'
-
-    # Set short timeout
-    sock.settimeout(30)
-
-    # Connect to remote server
-    try:
-        error = None
-        #  print('# Connecting to server, ' + appip + ' (' + remote_ip + ')')
-        sock.connect((remote_ip , port))
     except ConnectionRefusedError:
-        error = appip + " connection refused"
-        sock.close()
-        sock = None
-    except TimeoutError:
-        error = appip + " Connect TimeoutError"
-        sock.close()
-        sock = None
-    except socket.error:
-        error = appip + " No route to host"
-        sock.close()
-        sock = None
-
-    if sock is None:
-        return error
-
-    sock.settimeout(None)
-    # Set longer timeout
-    sock.settimeout(60)
-    return sock
+        return appip + " connection refused"
+    except asyncio.TimeoutError:
+        return appip + " Connect TimeoutError"
+    except OSError:
+        return appip + " No route to host"
+    return connection
 
 class FluxAgent:
     '''Class for the Secure Vault Agent, runs on secured trusted server or PC behind firewall'''
@@ -400,6 +606,8 @@ class FluxAgent:
         self.log = []
         self.verbose = False
         self.matched = False
+        # CRCs of files already checked, see file_crc
+        self.crc_cache = {}
 
     def add_log(self, msg):
         '''Add logging of notable events'''
@@ -411,7 +619,8 @@ class FluxAgent:
 
     def vault_agent(self):
         '''Invokes requested agent action defined by FluxVault or user defined class'''
-        node_func = self.agent_requests.get(self.request["State"], None)
+        state = self.request.get("State")
+        node_func = self.agent_requests.get(state) if isinstance(state, str) else None
         if node_func is None:
             return None
         jdata = node_func()
@@ -422,51 +631,68 @@ class FluxAgent:
         # The Node is done with us, Get Out!
         return self.request
 
+    def file_path(self, fname) -> str:
+        '''
+        Local path of a managed file, file_dir does not need a trailing separator
+        Returns None if the Node asks for an absolute name or one that uses .. to leave
+        file_dir, symlinks placed inside file_dir are followed wherever they point
+        '''
+        root = os.path.abspath(self.file_dir)
+        path = os.path.normpath(os.path.join(root, fname))
+        if os.path.commonpath([root, path]) != root:
+            return None
+        return path
+
     def node_request(self):
-        '''Node is requesting a file'''
-        fname = self.request["FILE"]
-        crc = int(self.request["crc32"])
+        '''Node is requesting a file, returns None to end the session if the request is malformed'''
+        fname = self.request.get("FILE")
+        crc = self.request.get("crc32")
+        if not isinstance(fname, str) or not isinstance(crc, int):
+            self.result = "Malformed Request"
+            self.add_log(self.result)
+            return None
+        path = self.file_path(fname)
         self.request["State"] = "DATA"
-        # Open the file, read contents and compute the crc
-        # if the CRC matches no need to resent
-        # if it does not exist locally report the error
+        # Compute the crc a chunk at a time, if the CRC matches no need to resent
+        # otherwise read contents (as bytes, never decoded) to send
+        # if it does not exist locally (or is not a readable file) report the error
         try:
-            with open(self.file_dir+fname, encoding="utf-8") as file:
-                secret = file.read()
-                file.close()
-            mycrc = binascii.crc32(secret.encode("utf-8"))
-            if crc == mycrc:
+            if path is None:
+                raise FileNotFoundError(fname)
+            if crc == file_crc(path, self.crc_cache):
                 if self.verbose:
                     print("File " + fname + " Matched!")
                 self.request["Status"] = "Match"
-                self.request["Body"] = ""
+                self.request["Body"] = b""
             else:
+                with open(path, "rb") as file:
+                    self.request["Body"] = file.read()
                 self.add_log("File " + fname + " sent!")
-                self.request["Body"] = secret
                 self.request["Status"] = "Success"
                 self.matched = False
-        except FileNotFoundError:
-            self.add_log("File Not Found: " + self.file_dir+fname)
-            self.request["Body"] = ""
+        except (OSError, ValueError):
+            # ValueError is a name open() refuses, such as one with a NUL byte
+            self.add_log("File Not Found: " + (path or fname))
+            self.request["Body"] = b""
             self.request["Status"] = "FileNotFound"
             self.matched = False
         return self.request
 
-    def do_encrypted(self, sock, aeskey, jdata):
+    async def do_encrypted(self, reader, writer, aead, jdata):
         '''
         This function will send the reply and process any file requests it receives
-        The rest of the session will use the aeskey to protect the session
-        send_files(sock, jdata, aeskey, file_dir)'''
+        The rest of the session will use the aead to protect the session
+        send_files(sock, jdata, aead, file_dir)'''
         while True:
             # Encrypt the latest reply
-            data = encrypt_aes_data(aeskey, jdata)
-            reply = send_receive(sock, data)
+            data = encrypt_aes_data(aead, jdata)
+            reply = await send_receive(reader, writer, data)
             if reply is None:
                 self.result = 'Receive Time out'
                 self.add_log(self.result)
                 break
             # Reply sent and next command received, decrypt and process
-            self.request = decrypt_aes_data(aeskey, reply)
+            self.request = decrypt_aes_data(aead, reply)
             # call vault_agent functions
             jdata = self.vault_agent()
             if jdata is None:
@@ -475,55 +701,45 @@ class FluxAgent:
                 self.result = "Completed"
                 break
 
-    def node_vault_ip(self, appip):
+    async def agent_session(self, reader, writer):
         '''
-        This is where all the Vault work is done.
-        Use the port and appip to connect to a Node and give it files it asks for
+        Key exchange with the Node on a new connection, then serve its requests
+        The caller owns the connection and closes it when this returns
         '''
-
-        if self.vault_port == 0:
-            self.result = "vault_port Not set!"
-            self.add_log(self.result)
-            return
-        # Open socket to the node
-        sock = open_connection(self.vault_port, appip)
-        if isinstance(sock, str):
-            self.result = sock
-            if self.verbose:
-                print('Could not connect to Node')
-            self.add_log(self.result)
-            return
-
-        self.result = "Connected"
         # Use While loop to allow graceful escape on error
         while True:
-            # Node will generate a RSA Public/Private key pair and send us the Public Key
+            # Node will generate a X25519 Public/Private key pair and send us the Public Key
             # this message will be signed by the Flux Node private key so we can authenticate
             # that we are connected to node we expect (no man in the middle)
 
-            public_key = receive_public_key(sock)
-            if public_key is None:
+            node_key = await receive_public_key(reader)
+            if node_key is None:
                 self.result = "No Public Key Received"
                 self.add_log(self.result)
                 break
 
-            # Generate and send AES Key encrypted with PublicKey just received
+            # Generate our own key pair and derive the session key with the PublicKey just received
             # These are only used for this session and are memory resident
-            aeskey = get_random_bytes(16).hex().encode("utf-8")
-            # Create a cypher message (json) and the data is simply the aeskey we will use
-            jdata = encrypt_data(public_key, aeskey)
-            # The State reflects what format the cypher message is
-            jdata["State"] = AESKEY
-            data = json.dumps(jdata)
+            private_key = X25519PrivateKey.generate()
+            try:
+                public_key, session_cipher = node_key
+                aead = session_cipher(derive_session_key(private_key, public_key))
+            except ValueError:
+                self.result = "Key Agreement Failed"
+                self.add_log(self.result)
+                break
+            # Send our Public Key so the Node can derive the same session key
+            jdata = { "State": AESKEY, "PublicKey": public_key_bytes(private_key)}
+            data = pack_message(jdata)
 
             # Send the message and wait for the reply to verify the key exchange was successful
-            reply = send_receive(sock, data)
+            reply = await send_receive(reader, writer, data)
             if reply is None:
                 self.result = 'Receive Time out'
                 self.add_log(self.result)
                 break
             # AES Encryption should be started now, decrypt the message and validate the reply
-            jdata = decrypt_aes_data(aeskey, reply)
+            jdata = decrypt_aes_data(aead, reply)
             if jdata["State"] != STARTAES:
                 self.result = "StartAES not found"
                 self.add_log(self.result)
@@ -536,7 +752,32 @@ class FluxAgent:
             jdata["Text"] = "Passed"
 
             self.result = "Connected and Encrypted"
-            self.do_encrypted(sock, aeskey, jdata)
+            await self.do_encrypted(reader, writer, aead, jdata)
             break
-        sock.close()
-        return
+
+    async def node_vault_ip(self, appip):
+        '''
+        This is where all the Vault work is done.
+        Use the port and appip to connect to a Node and give it files it asks for
+        Many nodes can be served concurrently, each with its own FluxAgent
+        '''
+
+        if self.vault_port == 0:
+            self.result = "vault_port Not set!"
+            self.add_log(self.result)
+            return
+        # Open socket to the node
+        connection = await open_connection(self.vault_port, appip)
+        if isinstance(connection, str):
+            self.result = connection
+            if self.verbose:
+                print('Could not connect to Node')
+            self.add_log(self.result)
+            return
+
+        self.result = "Connected"
+        reader, writer = connection
+        try:
+            await self.agent_session(reader, writer)
+        finally:
+            await close_connection(writer)
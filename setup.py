@@ -10,5 +10,9 @@ setup(name='fluxvault',
       author_email='tom@moulton.us',
       url='https://github.com/RunOnFlux/FluxVault.git',
       packages=['fluxvault'],
-      install_requires=['pycryptodome'] #external packages as dependencies
+      #external packages as dependencies
+      install_requires=['cryptography', 'msgpack'],
+      # optional faster asyncio event loop
+      extras_require={'fast': ["uvloop; sys_platform != 'win32'",
+                               "winloop; sys_platform == 'win32'"]}
 )
@@ -1,10 +1,11 @@
 #!/usr/bin/python3
 '''This module is a single file that supports the loading of secrets into a Flux Node'''
+import argparse
+import asyncio
 import json
-import sys
 import os
 import requests
-from fluxvault import FluxAgent
+from fluxvault import FluxAgent, use_fast_event_loop
 
 VAULT_NAME = os.getenv('VAULT_NAME')      # EDIT ME
 VAULT_PORT = os.getenv('VAULT_PORT')      # EDIT ME
@@ -12,6 +13,13 @@ APP_NAME = os.getenv('VAULT_APP')         # EDIT ME
 FILE_DIR = os.getenv('VAULT_FILE_DIR')    # EDIT ME
 
 VERBOSE = True
+MAX_NODES = 32      # Limit on nodes polled at the same time
+
+# Keep the HTTPS connection to the Flux API warm between polls
+SESSION = requests.Session()
+
+# Every node asks for the same files, CRC each unchanged file once per run
+CRC_CACHE = {}
 
 if VAULT_PORT is None:
     VAULT_PORT = 39898
@@ -33,44 +41,75 @@ class MyFluxAgent(FluxAgent):
         self.file_dir = FILE_DIR
         self.verbose = VERBOSE
 
+async def poll_node(node, limit):
+    '''Connect to one node, at most MAX_NODES run at once'''
+    agent = MyFluxAgent() # Each connection to a node get a fresh agent
+    agent.crc_cache = CRC_CACHE
+    ipadr = node['ip'].split(':')[0]
+    async with limit:
+        if VERBOSE:
+            print(node['name'], ipadr)
+        await agent.node_vault_ip(ipadr)
+        if VERBOSE:
+            print(node['name'], ipadr, agent.result)
+
+async def poll_nodes(nodes):
+    '''Poll all nodes concurrently, total time is that of the slowest node'''
+    limit = asyncio.Semaphore(MAX_NODES)
+    # One failing node must not abort the poll of the others
+    results = await asyncio.gather(*[poll_node(node, limit) for node in nodes],
+                                   return_exceptions=True)
+    for node, result in zip(nodes, results):
+        if isinstance(result, Exception):
+            print(node['name'], "Error", repr(result))
+
+def eager_event_loop():
+    '''
+    New event loop (uvloop if selected) for the Agent
+    Python 3.12+: each node task runs straight to its connect instead of
+    waiting for a loop iteration to be scheduled
+    '''
+    loop = asyncio.new_event_loop()
+    if hasattr(asyncio, "eager_task_factory"):
+        loop.set_task_factory(asyncio.eager_task_factory)
+    return loop
+
+def run_agent(coro):
+    '''Run the Agent on its own event loop, the task factory is set once when it is made'''
+    if hasattr(asyncio, "Runner"):
+        with asyncio.Runner(loop_factory=eager_event_loop) as runner:
+            return runner.run(coro)
+    return asyncio.run(coro)
+
 def node_vault():
     '''Vault runs this to poll every Flux node running their app'''
     url = "https://api.runonflux.io/apps/location/" + APP_NAME
-    req = requests.get(url, timeout=30)
+    req = SESSION.get(url, timeout=30)
     # Get the list of nodes where our app is deplolyed
     if req.status_code == 200:
         values = json.loads(req.text)
         if values["status"] == "success":
-            # json looks good and status correct, iterate through node list
-            nodes = values["data"]
-
-            for node in nodes:
-                agent = MyFluxAgent() # Each connection to a node get a fresh agent
-                ipadr = node['ip'].split(':')[0]
-                if VERBOSE:
-                    print(node['name'], ipadr)
-                agent.node_vault_ip(ipadr)
-                if VERBOSE:
-                    print(node['name'], ipadr, agent.result)
+            # json looks good and status correct, poll the node list
+            run_agent(poll_nodes(values["data"]))
         else:
             print("Error", req.text)
     else:
         print("Error", url, "Status", req.status_code)
 
+def parse_args():
+    '''Parse the command line in one pass'''
+    parser = argparse.ArgumentParser(
+        description="With no arguments all nodes running " + APP_NAME + " will be polled")
+    parser.add_argument("--ip", metavar="ipaddress",
+                        help="poll only the node at this ipaddress")
+    return parser.parse_args()
+
 if __name__ == "__main__":
-    if len(sys.argv) == 1:
+    args = parse_args()
+    use_fast_event_loop()
+    if args.ip is None:
         node_vault()
-        sys.exit(0)
-    if sys.argv[1].lower() == "--ip":
-        if len(sys.argv) > 2:
-            ipaddr = sys.argv[2]
-            one_node = MyFluxAgent()
-            one_node.node_vault_ip(ipaddr)
-            print(ipaddr, one_node.result)
-            sys.exit(0)
-        else:
-            print("Missing Node IP Address: --ip ipaddress")
-    print("Incorrect arguments:")
-    print("With no arguments all nodes running ", APP_NAME, " will be polled")
-    print("If you specify '--ip ipaddress' then that ipaddress will be polled")
-    sys.exit(1)
+    else:
+        one_node = MyFluxAgent()
+        run_agent(one_node.node_vault_ip(args.ip))
+        print(args.ip, one_node.result)
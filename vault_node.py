@@ -1,10 +1,10 @@
 #!/usr/bin/python3
 '''This module is a single file that supports the loading of secrets into a Flux Node'''
-import socketserver
-import threading
+import asyncio
+import logging
 import time
 import os
-from fluxvault import FluxNode
+from fluxvault import FluxNode, close_connection, use_fast_event_loop
 
 BOOTFILES = ["quotes.txt", "readme.txt"]    # EDIT ME
 
@@ -12,6 +12,11 @@ VAULT_NAME = os.getenv('VAULT_NAME')        # EDIT ME
 VAULT_PORT = os.getenv('VAULT_PORT')        # EDIT ME
 FILE_DIR = os.getenv('VAULT_FILE_DIR')      # EDIT ME
 
+VAULT_REFRESH = 300     # Seconds between DNS lookups of VAULT_NAME
+VAULT_RETRY = 10        # Seconds between lookups while VAULT_NAME has not resolved yet
+
+log = logging.getLogger("vault_node")
+
 if VAULT_NAME is None:
     VAULT_NAME = 'localhost'
 if VAULT_PORT is None:
@@ -27,38 +32,56 @@ class MyFluxNode(FluxNode):
     user_files = BOOTFILES
     file_dir = FILE_DIR
 
-class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    '''Define threaded server'''
-    daemon_threads = True
-    allow_reuse_address = True
-
-class NodeKeyClient(socketserver.StreamRequestHandler):
+async def node_key_client(reader, writer):
     '''
-    ThreadedTCPServer creates a new thread and calls this function for each
-    TCP connection received
+    The asyncio server calls this coroutine for each TCP connection received
     '''
+    peer_ip = writer.get_extra_info("peername")
+    log.info("Connected: %s", peer_ip)
+    # Create new fluxVault Object for this connection
     node = MyFluxNode()
-
-    def handle(self):
-        '''Handle new thread that accepted a new connection'''
-        client = f'{self.client_address} on {threading.current_thread().name}'
-        print(f'Connected: {client}')
-        peer_ip = self.connection.getpeername()
-        # Create new fluxVault Object
-        if self.node.connected(peer_ip):
+    try:
+        if node.connected(peer_ip):
             # Correct IP
-            self.node.handle(self.rfile.readline, self.wfile.write)
-        print(f'Closed: {client}')
+            await node.handle(reader, writer)
+    except Exception: # pylint: disable=broad-except
+        # One failed session must not take anything else down, report it and close
+        log.exception("Session failed: %s", peer_ip)
+    finally:
+        await close_connection(writer)
+        log.info("Closed: %s", peer_ip)
+
+async def refresh_vault_ip():
+    '''
+    Resolve VAULT_NAME every VAULT_REFRESH seconds, off the connection path
+    Retries every VAULT_RETRY seconds while it has never resolved
+    '''
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(VAULT_RETRY if len(MyFluxNode.vault_ip) == 0 else VAULT_REFRESH)
+        await loop.run_in_executor(None, MyFluxNode.resolve_vault_name)
 
-def node_server():
+async def node_server():
     '''This server runs on the Node, waiting for the Vault to connect'''
 
     print("node_server ", VAULT_NAME)
-    with ThreadedTCPServer(('', VAULT_PORT), NodeKeyClient) as server:
+    MyFluxNode.resolve_vault_name()
+    refresh = asyncio.create_task(refresh_vault_ip())
+    server = await asyncio.start_server(node_key_client, '', VAULT_PORT, reuse_address=True)
+    async with server:
         print("The NodeKeyClient server is running on port " + str(VAULT_PORT))
-        server.serve_forever()
+        try:
+            await server.serve_forever()
+        finally:
+            refresh.cancel()
 
 if __name__ == '__main__':
+    # Records only show the message, skip collecting thread and process details
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    use_fast_event_loop()
     while True:
         if VAULT_NAME == "localhost" and VAULT_PORT == 39898:
             print("Running in Demo Mode files will be placed in ", FILE_DIR)
@@ -68,7 +91,7 @@ if __name__ == '__main__':
             print("Creating ", FILE_DIR)
             os.makedirs(FILE_DIR)
         if os.path.exists(FILE_DIR):
-            node_server()
+            asyncio.run(node_server())
         else:
             print(FILE_DIR, " does not exist!")
             time.sleep(60)